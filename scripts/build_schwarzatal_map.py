@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 import argparse
 import datetime
+import hashlib
+import json
 import math
 import os
+from io import BytesIO
 from typing import Tuple, Optional, Dict, Any
 
 import matplotlib.pyplot as plt
 import numpy as np
 import contextily as cx
 import requests
+from matplotlib.collections import LineCollection
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 R_EARTH = 6378137.0  # Web Mercator sphere radius (meters)
-INITIAL_RESOLUTION_M_PER_PX = 2 * math.pi * R_EARTH / 256.0
+INITIAL_RESOLUTION_M_PER_PX = 2.0 * math.pi * R_EARTH / 256.0
+MAX_LAT_RAD = math.radians(85.05112878)  # Web-Mercator-Grenze
+CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "schwarzatal-map")
+TILE_CACHE_DIR = os.path.join(CACHE_ROOT, "tiles")
+TILE_CONNECTIONS = 4
+GEOCODE_CACHE_DIR = os.path.join(CACHE_ROOT, "geocode")
+
+# Eine Session für alle Nominatim-Anfragen (Keep-Alive, Wiederholungen)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3)))
 
 
 def ensure_dirs(*dirs: str) -> None:
@@ -29,28 +45,42 @@ def parse_size(size_str: str) -> Tuple[float, float]:
         raise argparse.ArgumentTypeError("--size erwartet Format wie 14x20 (in Zoll)") from exc
 
 
-def lonlat_to_webmercator(lon_deg: float, lat_deg: float) -> Tuple[float, float]:
-    lon_rad = math.radians(lon_deg)
-    lat_rad = math.radians(lat_deg)
-    x = R_EARTH * lon_rad
+def lonlat_to_webmercator(lon_deg, lat_deg):
+    """Akzeptiert Skalare oder Arrays (Grad) und liefert x, y in Metern."""
+    x = R_EARTH * np.radians(lon_deg)
     # clamp latitude for Web Mercator stability
-    lat_rad = max(min(lat_rad, math.radians(85.05112878)), math.radians(-85.05112878))
-    y = R_EARTH * math.log(math.tan(math.pi / 4.0 + lat_rad / 2.0))
+    lat_rad = np.clip(np.radians(lat_deg), -MAX_LAT_RAD, MAX_LAT_RAD)
+    y = R_EARTH * np.log(np.tan(np.pi / 4.0 + lat_rad / 2.0))
     return x, y
 
 
+def bbox_array_to_mercator(bboxes) -> np.ndarray:
+    """Rechnet ein (N, 4)-Array von WGS84-Boxen (min_lon, min_lat, max_lon, max_lat) in einem Schritt um."""
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    xs, ys = lonlat_to_webmercator(bboxes[:, [0, 2]], bboxes[:, [1, 3]])
+    return np.column_stack((xs.min(axis=1), ys.min(axis=1), xs.max(axis=1), ys.max(axis=1)))
+
+
 def bbox_wgs84_to_mercator(bbox: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
-    min_lon, min_lat, max_lon, max_lat = bbox
-    x_min, y_min = lonlat_to_webmercator(min_lon, min_lat)
-    x_max, y_max = lonlat_to_webmercator(max_lon, max_lat)
-    return (min(x_min, x_max), min(y_min, y_max), max(x_min, x_max), max(y_min, y_max))
+    minx, miny, maxx, maxy = bbox_array_to_mercator(bbox)[0]
+    return (float(minx), float(miny), float(maxx), float(maxy))
 
 
 def geocode_bbox(place: str, user_agent: str = "schwarzatal-map/1.0") -> Dict[str, Any]:
+    cache_path = os.path.join(GEOCODE_CACHE_DIR, f"{hashlib.sha1(place.encode('utf-8')).hexdigest()}.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        bbox = tuple(float(v) for v in cached["bbox_wgs84"])
+        if len(bbox) == 4:
+            return {"display_name": str(cached["display_name"]), "bbox_wgs84": bbox}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": place, "format": "json", "limit": 1, "polygon_geojson": 0, "addressdetails": 0}
     headers = {"User-Agent": user_agent}
-    resp = requests.get(url, params=params, headers=headers, timeout=30)
+    resp = _SESSION.get(url, params=params, headers=headers, timeout=30)
     resp.raise_for_status()
     data = resp.json()
     if not data:
@@ -62,7 +92,43 @@ def geocode_bbox(place: str, user_agent: str = "schwarzatal-map/1.0") -> Dict[st
     # Nominatim order: [south, north, west, east]
     south, north, west, east = map(float, bb)
     bbox_wgs84 = (west, south, east, north)
-    return {"display_name": item.get("display_name", place), "bbox_wgs84": bbox_wgs84}
+    result = {"display_name": item.get("display_name", place), "bbox_wgs84": bbox_wgs84}
+
+    try:
+        ensure_dirs(GEOCODE_CACHE_DIR)
+        # Atomar schreiben, damit ein abgebrochener Lauf keine halbe Datei hinterlässt
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warnung: Geocoding-Cache nicht beschreibbar: {e}")
+    return result
+
+
+def blend_layer(out: np.ndarray, layer: np.ndarray, alpha: float, band_rows: int = 256) -> None:
+    """Blendet eine RGBA-Kachelebene mit Deckkraft `alpha` in-place über `out` (RGB, uint8).
+
+    Gerechnet wird streifenweise in float32, damit der Speicherbedarf bei der
+    Größe der Kacheln bleibt statt mehrerer Vollbild-Kopien.
+    """
+    if layer.shape[:2] != out.shape[:2]:
+        layer = np.asarray(Image.fromarray(layer).resize((out.shape[1], out.shape[0]), Image.BILINEAR))
+    has_alpha = layer.shape[2] == 4
+    for y0 in range(0, out.shape[0], band_rows):
+        dst = out[y0:y0 + band_rows]
+        src = layer[y0:y0 + band_rows]
+        band = dst.astype(np.float32)
+        diff = np.subtract(band, src[..., :3], dtype=np.float32)
+        if has_alpha:
+            # Transparente Kachelbereiche (z. B. Label-Layer) berücksichtigen
+            diff *= src[..., 3:4] * np.float32(alpha / 255.0)
+        else:
+            diff *= np.float32(alpha)
+        band -= diff
+        np.rint(band, out=band)
+        np.clip(band, 0, 255, out=band)
+        dst[...] = band
 
 
 def add_north_arrow(ax, xy=(0.05, 0.08), size=0.05, text="N"):
@@ -96,9 +162,14 @@ def add_scale_bar(ax, length_km: Optional[float] = None, location=(0.82, 0.05)):
     x_start = xlim[0] + (xlim[1] - xlim[0]) * location[0]
     y_start = ylim[0] + (ylim[1] - ylim[0]) * location[1]
 
-    ax.plot([x_start, x_start + length_m], [y_start, y_start], color="k", linewidth=3, zorder=100)
-    ax.plot([x_start, x_start], [y_start - length_m * 0.003, y_start + length_m * 0.003], color="k", linewidth=3, zorder=100)
-    ax.plot([x_start + length_m, x_start + length_m], [y_start - length_m * 0.003, y_start + length_m * 0.003], color="k", linewidth=3, zorder=100)
+    # Balken und beide Endmarken als eine Collection zeichnen
+    tick = length_m * 0.003
+    segments = [
+        [(x_start, y_start), (x_start + length_m, y_start)],
+        [(x_start, y_start - tick), (x_start, y_start + tick)],
+        [(x_start + length_m, y_start - tick), (x_start + length_m, y_start + tick)],
+    ]
+    ax.add_collection(LineCollection(segments, colors="k", linewidths=3, zorder=100), autolim=False)
     ax.text(x_start + length_m / 2, y_start + length_m * 0.006, f"{int(length_m/1000)} km", ha="center", va="bottom", fontsize=9)
 
 
@@ -109,6 +180,8 @@ def plot_map(
     buffer_m: float,
     out_base: str,
     labels_language: str,
+    tile_cache_dir: Optional[str] = TILE_CACHE_DIR,
+    tile_connections: int = TILE_CONNECTIONS,
 ):
     print(f"Erzeuge Karte für: {place}")
     geocoded = geocode_bbox(place)
@@ -123,6 +196,14 @@ def plot_map(
         maxx += buffer_m
         maxy += buffer_m
 
+    # Kacheln dauerhaft auf Platte cachen, damit Folgeläufe ohne Netz auskommen
+    if tile_cache_dir:
+        try:
+            ensure_dirs(tile_cache_dir)
+            cx.set_cache_dir(tile_cache_dir)
+        except OSError as e:
+            print(f"Warnung: Kachel-Cache nicht beschreibbar, nutze temporären Cache: {e}")
+
     print("Zeichne …")
     fig, ax = plt.subplots(1, 1, figsize=fig_size, dpi=dpi, constrained_layout=True)
 
@@ -137,30 +218,38 @@ def plot_map(
     zoom = int(round(math.log2(INITIAL_RESOLUTION_M_PER_PX / max(target_res_m_per_px, 1e-6))))
     zoom = max(0, min(19, zoom))
 
-    # Basiskarte: aktuelle Esri World Imagery
-    cx.add_basemap(ax, crs="EPSG:3857", source=cx.providers.Esri.WorldImagery, zoom=zoom)
-
-    # Hillshade-Overlay für Höhenwirkung
-    try:
-        cx.add_basemap(ax, crs="EPSG:3857", source=cx.providers.Esri.WorldHillshade, alpha=0.35, zoom=zoom)
-    except Exception as e:
-        print(f"Warnung: Hillshade-Overlay nicht verfügbar: {e}")
-
-    # Topo/Transport-Overlay für Infrastruktur und ggf. Konturen
-    try:
-        cx.add_basemap(ax, crs="EPSG:3857", source=cx.providers.Esri.WorldTransportation, alpha=0.6, zoom=zoom)
-    except Exception as e:
-        print(f"Warnung: Transportation-Overlay nicht verfügbar: {e}")
-    try:
-        cx.add_basemap(ax, crs="EPSG:3857", source=cx.providers.Esri.WorldTopoMap, alpha=0.25, zoom=zoom)
-    except Exception as e:
-        print(f"Warnung: Topo-Overlay nicht verfügbar: {e}")
+    # Alle Quellen im selben Kachelraster holen, in NumPy übereinanderblenden
+    # und nur einmal mit imshow zeichnen
+    def fetch(source):
+        return cx.bounds2img(minx, miny, maxx, maxy, zoom=zoom, source=source, ll=False, n_connections=tile_connections)
 
-    # Label-Overlay für hochwertige Beschriftungen
-    try:
-        cx.add_basemap(ax, crs="EPSG:3857", source=cx.providers.CartoDB.PositronOnlyLabels, alpha=0.9, zoom=zoom)
-    except Exception as e:
-        print(f"Warnung: Label-Overlay nicht verfügbar: {e}")
+    # Basiskarte: aktuelle Esri World Imagery
+    base_img, extent = fetch(cx.providers.Esri.WorldImagery)
+    composite = base_img[..., :3].copy()
+    attributions = [cx.providers.Esri.WorldImagery.get("attribution")]
+
+    overlays = [
+        # Hillshade-Overlay für Höhenwirkung
+        ("Hillshade", "Esri.WorldHillshade", 0.35),
+        # Topo/Transport-Overlay für Infrastruktur und ggf. Konturen
+        ("Transportation", "Esri.WorldTransportation", 0.6),
+        ("Topo", "Esri.WorldTopoMap", 0.25),
+        # Label-Overlay für hochwertige Beschriftungen
+        ("Label", "CartoDB.PositronOnlyLabels", 0.9),
+    ]
+    for name, provider, alpha in overlays:
+        try:
+            source = cx.providers.query_name(provider)
+            img, _ = fetch(source)
+            blend_layer(composite, img, alpha)
+            attributions.append(source.get("attribution"))
+        except Exception as e:
+            print(f"Warnung: {name}-Overlay nicht verfügbar: {e}")
+
+    ax.imshow(composite, extent=extent, interpolation="bilinear")
+    ax.set_xlim(minx, maxx)
+    ax.set_ylim(miny, maxy)
+    cx.add_attribution(ax, " | ".join(dict.fromkeys(a for a in attributions if a)))
 
     # Schmuckelemente
     add_north_arrow(ax)
@@ -181,11 +270,18 @@ def plot_map(
     out_png = f"{out_base}.png"
     out_pdf = f"{out_base}.pdf"
 
+    # Nur einmal rastern: PNG im Speicher erzeugen und daraus auch das PDF schreiben
     print(f"Speichere {out_png} …")
-    fig.savefig(out_png, dpi=dpi, bbox_inches="tight")
+    png_buf = BytesIO()
+    fig.savefig(png_buf, format="png", dpi=dpi, bbox_inches="tight", pil_kwargs={"compress_level": 1})
+    with open(out_png, "wb") as f:
+        f.write(png_buf.getbuffer())
 
     print(f"Speichere {out_pdf} …")
-    fig.savefig(out_pdf, dpi=dpi, bbox_inches="tight")
+    png_buf.seek(0)
+    with Image.open(png_buf) as img:
+        img.convert("RGB").save(out_pdf, "PDF", resolution=dpi, quality=95)
+    plt.close(fig)
 
     print("Fertig.")
 
@@ -197,6 +293,8 @@ def main():
     parser.add_argument("--dpi", default=300, type=int, help="Auflösung in DPI")
     parser.add_argument("--buffer-m", default=0.0, type=float, help="Zusätzlicher Puffer um die Region in Metern (Web Mercator)")
     parser.add_argument("--out", default="/workspace/output/schwarzatal_map", help="Basispfad ohne Endung für Export")
+    parser.add_argument("--tile-cache", default=TILE_CACHE_DIR, help="Verzeichnis für den Kachel-Cache (leer = nur temporärer Cache)")
+    parser.add_argument("--tile-connections", default=TILE_CONNECTIONS, type=int, help="Gleichzeitige Verbindungen je Kachel-Dienst (1 = seriell)")
     parser.add_argument("--labels-language", default="de", help="Label-Sprache (informativ; Kachel-Labels sind mehrsprachig)")
 
     args = parser.parse_args()
@@ -209,6 +307,8 @@ def main():
         buffer_m=args.buffer_m,
         out_base=args.out,
         labels_language=args.labels_language,
+        tile_cache_dir=args.tile_cache,
+        tile_connections=args.tile_connections,
     )
 
 